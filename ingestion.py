@@ -0,0 +1,236 @@
+import asyncio
+import logging
+import time
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+from models import WebhookEvent
+from pending_store import PendingEventStore
+
+logger = logging.getLogger(__name__)
+
+Handler = Callable[[WebhookEvent], Awaitable[None]]
+
+
+class IngestionGate:
+    """
+    Bounds the memory held by webhook requests that are being processed.
+    Every request reserves its body size before it is parsed and releases it
+    once its Mailerlite calls finish. Requests that would push the total past
+    the cap are rejected so bursts get backpressure instead of exhausting memory.
+
+    The gate also tracks the handler tasks so shutdown can stop accepting
+    events, drain the running ones within one time budget and hand whatever
+    is left to the pending event store, where any instance replays it.
+    """
+
+    def __init__(self, max_inflight_bytes: int, store: PendingEventStore, max_concurrent_replays: int = 10):
+        self.max_inflight_bytes = max_inflight_bytes
+        self.store = store
+        self.max_concurrent_replays = max_concurrent_replays
+        self.inflight_bytes = 0
+        self.closed = False
+        self.shutdown_deadline: Optional[float] = None
+        # task -> (event, reserved bytes, whether to save the event if shutdown cuts it off)
+        self._tasks: Dict[asyncio.Task, Tuple[WebhookEvent, int, bool]] = {}
+        self._budget_spent = asyncio.Event()
+        self._subscriber_locks: Dict[str, asyncio.Lock] = {}
+        self._subscriber_lock_users: Dict[str, int] = {}
+
+    def try_acquire(self, size: int) -> bool:
+        """
+        Reserves `size` bytes, returns False if that would exceed the cap
+        """
+        if self.inflight_bytes + size > self.max_inflight_bytes:
+            logger.warning(
+                f"In-flight limit reached ({self.inflight_bytes}/{self.max_inflight_bytes} bytes), "
+                f"rejecting {size} bytes"
+            )
+            return False
+        self.inflight_bytes += size
+        return True
+
+    def release(self, size: int):
+        """
+        Returns bytes previously reserved with try_acquire
+        """
+        self.inflight_bytes = max(0, self.inflight_bytes - size)
+
+    def submit(self, event: WebhookEvent, handler: Handler, size: int = 0) -> asyncio.Task:
+        """
+        Runs the handler for an event as a tracked task.
+        The task is independent of the request, so a dropped connection
+        does not cut the Mailerlite calls off halfway. The `size` bytes
+        reserved for the event stay reserved until the task finishes.
+        """
+        task = asyncio.create_task(self._process(event, handler))
+        self._track(task, event, size, save_on_shutdown=True)
+        return task
+
+    def _track(self, task: asyncio.Task, event: WebhookEvent, size: int, save_on_shutdown: bool):
+        self._tasks[task] = (event, size, save_on_shutdown)
+        task.add_done_callback(self._task_done)
+
+    def _task_done(self, task: asyncio.Task):
+        event, size, _ = self._tasks.pop(task)
+        self.release(size)
+        # Failures are reported by whoever awaits the task; retrieve the
+        # exception here so tasks whose request went away don't warn at exit
+        if not task.cancelled() and task.exception() is not None:
+            logger.debug(f"Webhook task for {event.email} failed: {task.exception()}")
+
+    @asynccontextmanager
+    async def _subscriber_lock(self, email: str):
+        """
+        Serialises events for one subscriber so a replay never interleaves
+        with a live event for the same email
+        """
+        email = email.lower()
+        lock = self._subscriber_locks.setdefault(email, asyncio.Lock())
+        self._subscriber_lock_users[email] = self._subscriber_lock_users.get(email, 0) + 1
+        try:
+            async with lock:
+                yield
+        finally:
+            self._subscriber_lock_users[email] -= 1
+            if not self._subscriber_lock_users[email]:
+                del self._subscriber_lock_users[email]
+                del self._subscriber_locks[email]
+
+    async def _process(self, event: WebhookEvent, handler: Handler):
+        async with self._subscriber_lock(event.email):
+            try:
+                await self.store.record_started(event.email, event.received_at)
+            except Exception as e:
+                logger.warning(f"Could not record event time for {event.email}: {str(e)}")
+            await handler(event)
+
+    async def _replay(self, key: str, handler: Handler, event: WebhookEvent):
+        """
+        Replays a claimed event. It leaves the store only once the handler
+        succeeds; on failure or cancellation the claim is released so the
+        event is replayed again later.
+        """
+        try:
+            async with self._subscriber_lock(event.email):
+                # The wait for the lock may have used up part of the lease
+                renewed = await self.store.renew(key)
+                if renewed is None:
+                    logger.warning(f"Lost the claim on a pending {event.event} event for {event.email}, not replaying it")
+                    return
+                key = renewed
+
+                latest = await self.store.latest_started(event.email)
+                if latest is not None and latest > event.received_at:
+                    logger.info(f"Skipping stale {event.event} replay for {event.email}, a newer event was processed")
+                else:
+                    logger.info(f"Replaying pending webhook event {event.event} for {event.email}")
+                    await self.store.record_started(event.email, event.received_at)
+                    await handler(event)
+        except asyncio.CancelledError:
+            await self.store.release(key)
+            raise
+        except Exception as e:
+            logger.error(f"Error replaying webhook, it will be retried: {str(e)}", exc_info=True)
+            await self.store.release(key)
+            return
+
+        await self.store.complete(key)
+
+    @property
+    def replays_running(self) -> int:
+        return sum(1 for _, _, save_on_shutdown in self._tasks.values() if not save_on_shutdown)
+
+    async def replay_pending(self, handler: Handler) -> int:
+        """
+        Claims as many pending events as there are free replay slots and
+        replays them in the background. Replays count against the in-flight
+        byte cap like live events. Returns the number of replays started.
+        """
+        free_slots = self.max_concurrent_replays - self.replays_running
+        if self.closed or free_slots <= 0:
+            return 0
+
+        started = 0
+        for key, event in await self.store.claim(limit=free_slots):
+            size = event.approximate_size()
+            if self.closed or not self.try_acquire(size):
+                await self.store.release(key)
+                continue
+            task = asyncio.create_task(self._replay(key, handler, event))
+            # The claim is released on cancellation, so there is nothing to save
+            self._track(task, event, size, save_on_shutdown=False)
+            started += 1
+        return started
+
+    async def poll_pending(self, handler: Handler, interval: float):
+        """
+        Replays pending events until shutdown, so events saved by an instance
+        that stopped after this one started are picked up too. Polls every
+        `interval` seconds, or every second while a backlog is being worked off.
+        """
+        while not self.closed:
+            started = 0
+            try:
+                started = await self.replay_pending(handler)
+            except Exception as e:
+                logger.error(f"Error claiming pending webhook events: {str(e)}")
+            busy = started or self.replays_running >= self.max_concurrent_replays
+            await asyncio.sleep(1 if busy else interval)
+
+    def begin_shutdown(self, grace_period: float):
+        """
+        Stops accepting events and starts the shutdown budget. Safe to call
+        more than once; only the first call sets the deadline.
+        """
+        if self.closed:
+            return
+        self.closed = True
+        self.shutdown_deadline = time.monotonic() + grace_period
+        asyncio.get_running_loop().call_later(grace_period, self._budget_spent.set)
+        logger.info(f"Shutdown started, {len(self._tasks)} webhook event(s) in flight, grace period {grace_period}s")
+
+    def remaining_budget(self) -> Optional[float]:
+        if self.shutdown_deadline is None:
+            return None
+        return max(0.0, self.shutdown_deadline - time.monotonic())
+
+    async def wait(self, task: asyncio.Task) -> bool:
+        """
+        Waits for a task without cancelling it, giving up once the shutdown
+        budget is spent. Returns whether the task finished.
+        """
+        budget_spent = asyncio.create_task(self._budget_spent.wait())
+        try:
+            await asyncio.wait({task, budget_spent}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            budget_spent.cancel()
+        return task.done()
+
+    async def drain(self, grace_period: float):
+        """
+        Waits for running handlers until the shutdown budget is spent. Handlers
+        still running afterwards are cancelled and their events saved to the
+        store, to be replayed from the start by whichever instance claims them.
+        Mailerlite tag and group updates are idempotent, so replaying an event
+        completes any half-applied changes.
+        """
+        self.begin_shutdown(grace_period)
+        if not self._tasks:
+            return
+
+        _, pending = await asyncio.wait(list(self._tasks), timeout=self.remaining_budget())
+        if not pending:
+            logger.info("All in-flight webhook events completed")
+            return
+
+        leftover = [self._tasks[task][0] for task in pending if self._tasks[task][2]]
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        try:
+            await self.store.save(leftover)
+        except Exception as e:
+            emails = ", ".join(f"{event.event} for {event.email}" for event in leftover)
+            logger.error(f"Could not save unfinished webhook events ({emails}): {str(e)}")
+
@@ -1,12 +1,20 @@
 from fastapi import FastAPI, HTTPException, Request, status
+from fastapi.exceptions import RequestValidationError
 from fastapi.responses import JSONResponse
+from pydantic import ValidationError
 from pydantic_settings import BaseSettings
 from typing import Optional
+import asyncio
+import email.message
+import json
 import logging
+import signal
 from contextlib import asynccontextmanager
 
-from models import MemberpressWebhook
+from models import MemberpressWebhook, WebhookEvent
 from mailerlite_service import MailerliteService
+from ingestion import IngestionGate
+from pending_store import FilePendingStore, RedisPendingStore
 
 # Configure logging
 logging.basicConfig(
@@ -23,6 +31,13 @@ class Settings(BaseSettings):
     memberpress_webhook_secret: Optional[str] = None
     host: str = "0.0.0.0"
     port: int = 8000
+    max_body_bytes: int = 64 * 1024
+    max_inflight_bytes: int = 8 * 1024 * 1024
+    shutdown_grace_period: float = 20.0
+    pending_events_dir: str = "pending_events"
+    pending_events_redis_url: Optional[str] = None
+    pending_events_poll_interval: float = 30.0
+    pending_events_retention: float = 7 * 24 * 3600
 
     class Config:
         env_file = ".env"
@@ -34,6 +49,55 @@ mailerlite = MailerliteService(
     active_group_id=settings.mailerlite_active_group_id,
     cancelled_group_id=settings.mailerlite_cancelled_group_id
 )
+if settings.pending_events_redis_url:
+    pending_store = RedisPendingStore.from_url(
+        settings.pending_events_redis_url,
+        retention_seconds=settings.pending_events_retention
+    )
+else:
+    pending_store = FilePendingStore(
+        settings.pending_events_dir,
+        retention_seconds=settings.pending_events_retention
+    )
+ingestion_gate = IngestionGate(
+    max_inflight_bytes=settings.max_inflight_bytes,
+    store=pending_store
+)
+
+
+def install_shutdown_signal_handlers():
+    """
+    Closes the ingestion gate as soon as the server receives a shutdown signal,
+    so the grace period covers the server's wait for open requests as well as
+    the drain in lifespan shutdown. Chains to the server's own handlers, which
+    uvicorn installs with signal.signal before lifespan startup runs.
+    Returns whether handlers were installed for both signals.
+    """
+    loop = asyncio.get_running_loop()
+    installed = True
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        previous = signal.getsignal(sig)
+        if not callable(previous):
+            logger.warning(
+                f"No server handler for {sig.name}, the gate will only close at lifespan shutdown "
+                f"and the grace period will not cover the wait for open requests"
+            )
+            installed = False
+            continue
+
+        def handler(signum, frame, previous=previous):
+            loop.call_soon_threadsafe(ingestion_gate.begin_shutdown, settings.shutdown_grace_period)
+            previous(signum, frame)
+
+        try:
+            signal.signal(sig, handler)
+        except ValueError:
+            logger.warning(
+                "Not running in the main thread, the gate will only close at lifespan shutdown "
+                "and the grace period will not cover the wait for open requests"
+            )
+            return False
+    return installed
 
 
 @asynccontextmanager
@@ -42,8 +106,19 @@ async def lifespan(app: FastAPI):
     logger.info(f"Mailerlite API configured: {'Yes' if settings.mailerlite_api_key else 'No'}")
     logger.info(f"Active Group ID: {settings.mailerlite_active_group_id or 'Not set'}")
     logger.info(f"Cancelled Group ID: {settings.mailerlite_cancelled_group_id or 'Not set'}")
+
+    install_shutdown_signal_handlers()
+    poller = asyncio.create_task(
+        ingestion_gate.poll_pending(dispatch_event, settings.pending_events_poll_interval)
+    )
+
     yield
     logger.info("Shutting down Awaken Hook service...")
+    ingestion_gate.begin_shutdown(settings.shutdown_grace_period)
+    poller.cancel()
+    await asyncio.gather(poller, return_exceptions=True)
+    await ingestion_gate.drain(settings.shutdown_grace_period)
+    await pending_store.close()
 
 
 app = FastAPI(
@@ -54,6 +129,7 @@ app = FastAPI(
 )
 
 
+
 @app.get("/")
 async def root():
     return {
@@ -71,67 +147,204 @@ async def health_check():
     }
 
 
-@app.post("/webhook/memberpress")
-async def memberpress_webhook(webhook: MemberpressWebhook, request: Request):
+async def read_webhook_body(request: Request) -> bytes:
+    """
+    Reads the request body while enforcing the maximum body size.
+    The bytes read are reserved on the ingestion gate; the caller must
+    release `len(body)` once the event has been processed.
+    """
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit() and int(content_length) > settings.max_body_bytes:
+        raise HTTPException(
+            status_code=413,
+            detail=f"Webhook body exceeds {settings.max_body_bytes} bytes"
+        )
+
+    body = bytearray()
+    try:
+        async for chunk in request.stream():
+            if len(body) + len(chunk) > settings.max_body_bytes:
+                raise HTTPException(
+                    status_code=413,
+                    detail=f"Webhook body exceeds {settings.max_body_bytes} bytes"
+                )
+            if not ingestion_gate.try_acquire(len(chunk)):
+                raise HTTPException(
+                    status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                    detail="Too many webhooks in flight, retry later",
+                    headers={"Retry-After": "5"}
+                )
+            body.extend(chunk)
+    except BaseException:
+        ingestion_gate.release(len(body))
+        raise
+
+    return bytes(body)
+
+
+def parse_webhook(request: Request, body: bytes) -> MemberpressWebhook:
+    """
+    Parses the body the way FastAPI parses a declared body parameter, so
+    content-type handling and validation errors stay the same
+    """
+    payload = None
+    if body:
+        payload = body
+        content_type = request.headers.get("content-type")
+        if content_type:
+            message = email.message.Message()
+            message["content-type"] = content_type
+            subtype = message.get_content_subtype()
+            if message.get_content_maintype() == "application" and (subtype == "json" or subtype.endswith("+json")):
+                try:
+                    payload = json.loads(body)
+                except json.JSONDecodeError as e:
+                    raise RequestValidationError([{
+                        "type": "json_invalid",
+                        "loc": ("body", e.pos),
+                        "msg": "JSON decode error",
+                        "input": {},
+                        "ctx": {"error": e.msg}
+                    }])
+                except UnicodeDecodeError:
+                    raise HTTPException(
+                        status_code=status.HTTP_400_BAD_REQUEST,
+                        detail="There was an error parsing the body"
+                    )
+
+    if payload is None:
+        raise RequestValidationError([{"type": "missing", "loc": ("body",), "msg": "Field required", "input": None}])
+
+    try:
+        return MemberpressWebhook.model_validate(payload, from_attributes=True)
+    except ValidationError as e:
+        raise RequestValidationError([
+            {**error, "loc": ("body", *error["loc"])}
+            for error in e.errors(include_url=False)
+        ])
+
+
+@app.post("/webhook/memberpress", include_in_schema=False)
+async def memberpress_webhook(request: Request):
     """
     Receives Memberpress webhook events and processes them
     """
+    if ingestion_gate.closed:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Service is shutting down, retry later",
+            headers={"Retry-After": "5"}
+        )
+
+    body = await read_webhook_body(request)
+    reserved = len(body)
+    submitted = False
+
     try:
+        webhook = parse_webhook(request, body)
+
         logger.info(f"Received webhook event: {webhook.event}")
         logger.info(f"Event type: {webhook.type}")
         logger.info(f"Member: {webhook.data.member.email}")
 
-        # Handle different event types
-        if webhook.event == "subscription-created":
-            await handle_subscription_created(webhook)
-        elif webhook.event == "subscription-cancelled":
-            await handle_subscription_cancelled(webhook)
-        elif webhook.event == "subscription-stopped":
-            await handle_subscription_stopped(webhook)
-        elif webhook.event == "subscription-paused":
-            await handle_subscription_paused(webhook)
-        elif webhook.event == "subscription-resumed":
-            await handle_subscription_resumed(webhook)
-        else:
-            logger.warning(f"Unhandled event type: {webhook.event}")
+        # Keep only the fields the handlers need while Mailerlite calls run,
+        # and shrink the reservation from the body to the compact record
+        event = WebhookEvent.from_webhook(webhook)
+        del webhook, body
+        event_size = min(reserved, event.approximate_size())
+        ingestion_gate.release(reserved - event_size)
+        reserved = event_size
+
+        # The handler keeps running if the request is cancelled and holds the
+        # reservation until it finishes; shutdown drains it through the gate
+        task = ingestion_gate.submit(event, dispatch_event, size=reserved)
+        submitted = True
+        if not await ingestion_gate.wait(task) or task.cancelled():
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Service is shutting down, retry later",
+                headers={"Retry-After": "5"}
+            )
+
+        try:
+            task.result()
+        except Exception as e:
+            logger.error(f"Error processing webhook: {str(e)}", exc_info=True)
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail=f"Error processing webhook: {str(e)}"
+            )
 
         return JSONResponse(
             status_code=status.HTTP_200_OK,
             content={
                 "status": "success",
-                "message": f"Event {webhook.event} processed successfully"
+                "message": f"Event {event.event} processed successfully"
             }
         )
 
-    except Exception as e:
-        logger.error(f"Error processing webhook: {str(e)}", exc_info=True)
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=f"Error processing webhook: {str(e)}"
-        )
+    finally:
+        if not submitted:
+            ingestion_gate.release(reserved)
+
+
+async def document_memberpress_webhook(webhook: MemberpressWebhook):
+    """
+    Receives Memberpress webhook events and processes them
+    """
 
 
-async def handle_subscription_created(webhook: MemberpressWebhook):
+# Documents the webhook body in /openapi.json and /docs. Requests never reach
+# this route: memberpress_webhook matches first and reads the body itself
+app.add_api_route(
+    "/webhook/memberpress",
+    document_memberpress_webhook,
+    methods=["POST"],
+    summary="Memberpress Webhook",
+    operation_id="memberpress_webhook_webhook_memberpress_post"
+)
+
+
+async def dispatch_event(event: WebhookEvent):
+    """
+    Routes a webhook event to its handler
+    """
+    # Handle different event types
+    if event.event == "subscription-created":
+        await handle_subscription_created(event)
+    elif event.event == "subscription-cancelled":
+        await handle_subscription_cancelled(event)
+    elif event.event == "subscription-stopped":
+        await handle_subscription_stopped(event)
+    elif event.event == "subscription-paused":
+        await handle_subscription_paused(event)
+    elif event.event == "subscription-resumed":
+        await handle_subscription_resumed(event)
+    else:
+        logger.warning(f"Unhandled event type: {event.event}")
+
+
+async def handle_subscription_created(event: WebhookEvent):
     """
     Handles subscription-created event
     Creates/updates subscriber in Mailerlite with all relevant data
     """
-    logger.info(f"Processing subscription creation for {webhook.data.member.email}")
+    logger.info(f"Processing subscription creation for {event.email}")
 
     try:
         result = await mailerlite.create_or_update_subscriber(
-            email=webhook.data.member.email,
-            first_name=webhook.data.member.first_name,
-            last_name=webhook.data.member.last_name,
-            membership_title=webhook.data.membership.title,
-            membership_id=webhook.data.membership.id,
-            subscription_id=webhook.data.subscr_id,
-            price=webhook.data.price,
-            period=webhook.data.period,
-            period_type=webhook.data.period_type
+            email=event.email,
+            first_name=event.first_name,
+            last_name=event.last_name,
+            membership_title=event.membership_title,
+            membership_id=event.membership_id,
+            subscription_id=event.subscription_id,
+            price=event.price,
+            period=event.period,
+            period_type=event.period_type
         )
 
-        logger.info(f"Successfully created/updated subscriber in Mailerlite: {webhook.data.member.email}")
+        logger.info(f"Successfully created/updated subscriber in Mailerlite: {event.email}")
         return result
 
     except Exception as e:
@@ -139,23 +352,23 @@ async def handle_subscription_created(webhook: MemberpressWebhook):
         raise
 
 
-async def handle_subscription_cancelled(webhook: MemberpressWebhook):
+async def handle_subscription_cancelled(event: WebhookEvent):
     """
     Handles subscription-cancelled event
     Removes active subscription tag from subscriber
     """
-    logger.info(f"Processing subscription cancellation for {webhook.data.member.email}")
+    logger.info(f"Processing subscription cancellation for {event.email}")
 
     try:
-        await mailerlite.remove_subscription_tag(webhook.data.member.email)
-        logger.info(f"Successfully processed subscription cancellation: {webhook.data.member.email}")
+        await mailerlite.remove_subscription_tag(event.email)
+        logger.info(f"Successfully processed subscription cancellation: {event.email}")
 
     except Exception as e:
         logger.error(f"Failed to process subscription cancellation: {str(e)}")
         raise
 
 
-async def handle_subscription_stopped(webhook: MemberpressWebhook):
+async def handle_subscription_stopped(event: WebhookEvent):
     """
     Handles subscription-stopped event
     - Removes active_subscription tag
@@ -163,34 +376,34 @@ async def handle_subscription_stopped(webhook: MemberpressWebhook):
     - Removes from active group
     - Adds to cancelled group
     """
-    logger.info(f"Processing subscription stopped for {webhook.data.member.email}")
+    logger.info(f"Processing subscription stopped for {event.email}")
 
     try:
         await mailerlite.handle_subscription_stopped(
-            email=webhook.data.member.email,
-            membership_id=webhook.data.membership.id
+            email=event.email,
+            membership_id=event.membership_id
         )
-        logger.info(f"Successfully processed subscription stopped: {webhook.data.member.email}")
+        logger.info(f"Successfully processed subscription stopped: {event.email}")
 
     except Exception as e:
         logger.error(f"Failed to process subscription stopped: {str(e)}")
         raise
 
 
-async def handle_subscription_paused(webhook: MemberpressWebhook):
+async def handle_subscription_paused(event: WebhookEvent):
     """
     Handles subscription-paused event
     """
-    logger.info(f"Processing subscription pause for {webhook.data.member.email}")
+    logger.info(f"Processing subscription pause for {event.email}")
     # Implement custom logic for paused subscriptions if needed
     pass
 
 
-async def handle_subscription_resumed(webhook: MemberpressWebhook):
+async def handle_subscription_resumed(event: WebhookEvent):
     """
     Handles subscription-resumed event
     """
-    logger.info(f"Processing subscription resume for {webhook.data.member.email}")
+    logger.info(f"Processing subscription resume for {event.email}")
     # Implement custom logic for resumed subscriptions if needed
     pass
 
@@ -201,5 +414,6 @@ if __name__ == "__main__":
         "main:app",
         host=settings.host,
         port=settings.port,
-        reload=True
+        reload=True,
+        timeout_graceful_shutdown=settings.shutdown_grace_period
     )
@@ -1,3 +1,5 @@
+import sys
+import time
 from typing import Optional, List
 from pydantic import BaseModel, EmailStr
 
@@ -48,3 +50,81 @@ class MailerliteSubscriber(BaseModel):
     fields: dict
     groups: Optional[List[str]] = None
     status: str = "active"
+
+
+class WebhookEvent:
+    """
+    Compact record of a Memberpress webhook holding only the fields the
+    handlers read. Full payloads carry membership content, card data and
+    billing settings that are never used, so only this record is kept
+    while Mailerlite calls are in flight.
+    """
+    __slots__ = (
+        "event",
+        "email",
+        "first_name",
+        "last_name",
+        "membership_id",
+        "membership_title",
+        "subscription_id",
+        "price",
+        "period",
+        "period_type",
+        "received_at",
+    )
+
+    def __init__(
+        self,
+        event: str,
+        email: str,
+        first_name: str,
+        last_name: str,
+        membership_id: int,
+        membership_title: str,
+        subscription_id: str,
+        price: str,
+        period: str,
+        period_type: str,
+        received_at: Optional[float] = None
+    ):
+        self.event = event
+        self.email = email
+        self.first_name = first_name
+        self.last_name = last_name
+        self.membership_id = membership_id
+        self.membership_title = membership_title
+        self.subscription_id = subscription_id
+        self.price = price
+        self.period = period
+        self.period_type = period_type
+        # When the webhook arrived, used to order replays against newer events
+        self.received_at = time.time() if received_at is None else received_at
+
+    def approximate_size(self) -> int:
+        """
+        Approximate memory held by the record and its field values, in bytes
+        """
+        return sys.getsizeof(self) + sum(sys.getsizeof(getattr(self, name)) for name in self.__slots__)
+
+    def to_dict(self) -> dict:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "WebhookEvent":
+        return cls(**data)
+
+    @classmethod
+    def from_webhook(cls, webhook: MemberpressWebhook) -> "WebhookEvent":
+        data = webhook.data
+        return cls(
+            event=webhook.event,
+            email=data.member.email,
+            first_name=data.member.first_name,
+            last_name=data.member.last_name,
+            membership_id=data.membership.id,
+            membership_title=data.membership.title,
+            subscription_id=data.subscr_id,
+            price=data.price,
+            period=data.period,
+            period_type=data.period_type
+        )
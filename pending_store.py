@@ -0,0 +1,403 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import socket
+import time
+import uuid
+from abc import ABC, abstractmethod
+from typing import Dict, List, Optional, Tuple
+
+import redis.asyncio as redis
+
+from models import WebhookEvent
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_LEASE_SECONDS = 300.0
+DEFAULT_RETENTION_SECONDS = 7 * 24 * 3600.0
+
+
+def email_key(email: str) -> str:
+    """
+    Key for per-subscriber ordering data, so stores never hold plain emails
+    """
+    return hashlib.sha256(email.lower().encode()).hexdigest()
+
+
+def event_id(event: WebhookEvent) -> str:
+    # Prefixed with the receive time so sorting ids yields arrival order
+    return f"{int(event.received_at * 1000):013d}-{uuid.uuid4().hex}"
+
+
+class PendingEventStore(ABC):
+    """
+    Holds webhook events that a process could not finish before shutting down,
+    so any instance can claim and replay them.
+
+    Claimed events are leased rather than removed: an event only leaves the
+    store once its replay succeeds, and a lease left behind by a crashed
+    process expires so the event becomes claimable again.
+
+    The store also records, per subscriber, the receive time of the latest
+    event that started processing, so replays older than that can be skipped.
+    Those times are kept for `retention_seconds`; pending events older than
+    that can no longer be ordered and are set aside instead of replayed.
+    """
+
+    def __init__(self, lease_seconds: float, retention_seconds: float):
+        self.lease_seconds = lease_seconds
+        self.retention_seconds = retention_seconds
+
+    def is_expired(self, event: WebhookEvent) -> bool:
+        return time.time() - event.received_at > self.retention_seconds
+
+    @abstractmethod
+    async def save(self, events: List[WebhookEvent]):
+        """
+        Adds events to the store
+        """
+
+    @abstractmethod
+    async def claim(self, limit: int = 100) -> List[Tuple[str, WebhookEvent]]:
+        """
+        Leases up to `limit` pending events, oldest first, returns (key, event) pairs
+        """
+
+    @abstractmethod
+    async def renew(self, key: str) -> Optional[str]:
+        """
+        Restarts the lease on a claimed event. Returns the key to use from now
+        on, or None if the lease expired and another process took the event.
+        """
+
+    @abstractmethod
+    async def complete(self, key: str):
+        """
+        Removes a claimed event from the store
+        """
+
+    @abstractmethod
+    async def release(self, key: str):
+        """
+        Returns a claimed event to the store so it is replayed again
+        """
+
+    @abstractmethod
+    async def record_started(self, email: str, received_at: float):
+        """
+        Records that an event received at `received_at` started for `email`,
+        unless a later one already did
+        """
+
+    @abstractmethod
+    async def latest_started(self, email: str) -> Optional[float]:
+        """
+        Receive time of the latest event that started for `email`
+        """
+
+    async def close(self):
+        pass
+
+
+class FilePendingStore(PendingEventStore):
+    """
+    Stores pending events as one file per event in a directory. Only processes
+    sharing that directory see the events, so this suits a single host or a
+    shared volume. Files are published and claimed with os.replace, which is
+    atomic, so concurrent workers never replay the same event twice.
+    File access runs in a worker thread to keep it off the event loop.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        lease_seconds: float = DEFAULT_LEASE_SECONDS,
+        retention_seconds: float = DEFAULT_RETENTION_SECONDS
+    ):
+        super().__init__(lease_seconds, retention_seconds)
+        self.directory = directory
+        self.latest_directory = os.path.join(directory, "latest")
+        self.token = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        os.makedirs(self.latest_directory, exist_ok=True)
+
+    def _write_atomic(self, path: str, content: str):
+        tmp_path = f"{path}.{self.token}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+
+    def _claim_path(self, event_name: str) -> str:
+        # Claimed files are named <id>.json.<claimed_at_ms>.<token>.claimed
+        return os.path.join(self.directory, f"{event_name}.{int(time.time() * 1000)}.{self.token}.claimed")
+
+    @staticmethod
+    def _parse_claim(name: str) -> Tuple[str, float]:
+        event_name, _, rest = name[:-len(".claimed")].partition(".json.")
+        return f"{event_name}.json", int(rest.split(".", 1)[0]) / 1000
+
+    async def save(self, events: List[WebhookEvent]):
+        if not events:
+            return
+        await asyncio.to_thread(self._save, events)
+        logger.warning(f"Saved {len(events)} unfinished webhook event(s) to {self.directory}")
+
+    def _save(self, events: List[WebhookEvent]):
+        for event in events:
+            path = os.path.join(self.directory, f"{event_id(event)}.json")
+            self._write_atomic(path, json.dumps(event.to_dict()))
+
+    def _requeue_expired_claims(self):
+        now = time.time()
+        for name in os.listdir(self.directory):
+            if not name.endswith(".claimed"):
+                continue
+            try:
+                event_name, claimed_at = self._parse_claim(name)
+            except ValueError:
+                continue
+            if now - claimed_at <= self.lease_seconds:
+                continue
+            try:
+                os.replace(os.path.join(self.directory, name), os.path.join(self.directory, event_name))
+                logger.warning(f"Lease expired on pending event {event_name}, returning it to the store")
+            except FileNotFoundError:
+                pass
+
+    def _prune_latest(self):
+        cutoff = time.time() - self.retention_seconds
+        for name in os.listdir(self.latest_directory):
+            path = os.path.join(self.latest_directory, name)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    async def claim(self, limit: int = 100) -> List[Tuple[str, WebhookEvent]]:
+        return await asyncio.to_thread(self._claim, limit)
+
+    def _claim(self, limit: int) -> List[Tuple[str, WebhookEvent]]:
+        self._requeue_expired_claims()
+        self._prune_latest()
+
+        claimed = []
+        for name in sorted(os.listdir(self.directory)):
+            if len(claimed) >= limit:
+                break
+            if not name.endswith(".json"):
+                continue
+
+            path = os.path.join(self.directory, name)
+            key = self._claim_path(name)
+            try:
+                os.replace(path, key)
+            except FileNotFoundError:
+                # Claimed by another process first
+                continue
+
+            try:
+                with open(key, encoding="utf-8") as f:
+                    event = WebhookEvent.from_dict(json.load(f))
+            except (ValueError, TypeError) as e:
+                logger.error(f"Unreadable pending event {name}, moving it aside: {str(e)}")
+                os.replace(key, f"{path}.invalid")
+                continue
+            if self.is_expired(event):
+                logger.error(
+                    f"Pending {event.event} event for {event.email} is older than the retention "
+                    f"window and cannot be ordered safely, moving it aside as {name}.expired"
+                )
+                os.replace(key, f"{path}.expired")
+                continue
+            claimed.append((key, event))
+
+        return claimed
+
+    async def renew(self, key: str) -> Optional[str]:
+        return await asyncio.to_thread(self._renew, key)
+
+    def _renew(self, key: str) -> Optional[str]:
+        event_name, _ = self._parse_claim(os.path.basename(key))
+        renewed = self._claim_path(event_name)
+        try:
+            os.replace(key, renewed)
+        except FileNotFoundError:
+            return None
+        return renewed
+
+    async def complete(self, key: str):
+        await asyncio.to_thread(self._complete, key)
+
+    def _complete(self, key: str):
+        try:
+            os.remove(key)
+        except FileNotFoundError:
+            pass
+
+    async def release(self, key: str):
+        await asyncio.to_thread(self._release, key)
+
+    def _release(self, key: str):
+        event_name, _ = self._parse_claim(os.path.basename(key))
+        try:
+            os.replace(key, os.path.join(self.directory, event_name))
+        except FileNotFoundError:
+            pass
+
+    def _latest_path(self, email: str) -> str:
+        return os.path.join(self.latest_directory, email_key(email))
+
+    async def record_started(self, email: str, received_at: float):
+        await asyncio.to_thread(self._record_started, email, received_at)
+
+    def _record_started(self, email: str, received_at: float):
+        latest = self._latest_started(email)
+        if latest is None or received_at > latest:
+            self._write_atomic(self._latest_path(email), repr(received_at))
+
+    async def latest_started(self, email: str) -> Optional[float]:
+        return await asyncio.to_thread(self._latest_started, email)
+
+    def _latest_started(self, email: str) -> Optional[float]:
+        try:
+            with open(self._latest_path(email), encoding="utf-8") as f:
+                return float(f.read())
+        except (FileNotFoundError, ValueError):
+            return None
+
+
+# Lease operations only touch a lease still held by the caller's token
+RENEW_LEASE = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+RELEASE_LEASE = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+# Keeps the later of the stored and the given receive time, expiring after retention
+RECORD_STARTED = """
+local current = redis.call('GET', KEYS[1])
+if not current or tonumber(current) < tonumber(ARGV[1]) then
+    redis.call('SET', KEYS[1], ARGV[1], 'PX', ARGV[2])
+end
+return 0
+"""
+
+
+class RedisPendingStore(PendingEventStore):
+    """
+    Stores pending events in Redis so every instance can reach them, which is
+    what rolling deploys need when each instance has its own disk.
+    """
+
+    def __init__(
+        self,
+        client: redis.Redis,
+        lease_seconds: float = DEFAULT_LEASE_SECONDS,
+        retention_seconds: float = DEFAULT_RETENTION_SECONDS,
+        prefix: str = "awakenhook"
+    ):
+        super().__init__(lease_seconds, retention_seconds)
+        self.client = client
+        self.pending_key = f"{prefix}:pending"
+        self.invalid_key = f"{prefix}:invalid"
+        self.expired_key = f"{prefix}:expired"
+        self.lease_prefix = f"{prefix}:lease:"
+        self.latest_prefix = f"{prefix}:latest:"
+        self._lease_tokens: Dict[str, str] = {}
+        self._renew_lease = client.register_script(RENEW_LEASE)
+        self._release_lease = client.register_script(RELEASE_LEASE)
+        self._record_started = client.register_script(RECORD_STARTED)
+
+    @classmethod
+    def from_url(cls, url: str, **kwargs) -> "RedisPendingStore":
+        return cls(redis.from_url(url, decode_responses=True), **kwargs)
+
+    @property
+    def _lease_ms(self) -> int:
+        return int(self.lease_seconds * 1000)
+
+    async def save(self, events: List[WebhookEvent]):
+        if not events:
+            return
+        await self.client.hset(
+            self.pending_key,
+            mapping={event_id(event): json.dumps(event.to_dict()) for event in events}
+        )
+        logger.warning(f"Saved {len(events)} unfinished webhook event(s) to Redis")
+
+    async def _set_aside(self, hash_key: str, key: str, value: str):
+        await self.client.hset(hash_key, key, value)
+        await self.complete(key)
+
+    async def claim(self, limit: int = 100) -> List[Tuple[str, WebhookEvent]]:
+        claimed = []
+        for key, value in sorted((await self.client.hgetall(self.pending_key)).items()):
+            if len(claimed) >= limit:
+                break
+            token = uuid.uuid4().hex
+            acquired = await self.client.set(self.lease_prefix + key, token, nx=True, px=self._lease_ms)
+            if not acquired:
+                continue
+            self._lease_tokens[key] = token
+            if not await self.client.hexists(self.pending_key, key):
+                # Completed by another process since it was listed
+                await self.release(key)
+                continue
+
+            try:
+                event = WebhookEvent.from_dict(json.loads(value))
+            except (ValueError, TypeError) as e:
+                logger.error(f"Unreadable pending event {key}, moving it aside: {str(e)}")
+                await self._set_aside(self.invalid_key, key, value)
+                continue
+            if self.is_expired(event):
+                logger.error(
+                    f"Pending {event.event} event for {event.email} is older than the retention "
+                    f"window and cannot be ordered safely, moving it to {self.expired_key}"
+                )
+                await self._set_aside(self.expired_key, key, value)
+                continue
+            claimed.append((key, event))
+
+        return claimed
+
+    async def renew(self, key: str) -> Optional[str]:
+        token = self._lease_tokens.get(key)
+        if token is None:
+            return None
+        if not await self._renew_lease(keys=[self.lease_prefix + key], args=[token, self._lease_ms]):
+            self._lease_tokens.pop(key, None)
+            return None
+        return key
+
+    async def complete(self, key: str):
+        await self.client.hdel(self.pending_key, key)
+        await self.release(key)
+
+    async def release(self, key: str):
+        token = self._lease_tokens.pop(key, None)
+        if token is not None:
+            await self._release_lease(keys=[self.lease_prefix + key], args=[token])
+
+    async def record_started(self, email: str, received_at: float):
+        await self._record_started(
+            keys=[self.latest_prefix + email_key(email)],
+            args=[repr(received_at), int(self.retention_seconds * 1000)]
+        )
+
+    async def latest_started(self, email: str) -> Optional[float]:
+        value = await self.client.get(self.latest_prefix + email_key(email))
+        return float(value) if value is not None else None
+
+    async def close(self):
+        await self.client.aclose()
@@ -0,0 +1,506 @@
+"""
+Tests for webhook ingestion limits and for draining, saving and replaying events
+Usage: python -m pytest test_ingestion.py
+"""
+import asyncio
+import importlib
+import json
+import signal
+import time
+
+import httpx
+import pytest
+
+from ingestion import IngestionGate
+from models import MemberpressWebhook, WebhookEvent
+from pending_store import FilePendingStore, RedisPendingStore
+
+
+def make_event(event="subscription-stopped", email="test@example.com", received_at=None):
+    return WebhookEvent(
+        event=event,
+        email=email,
+        first_name="Test",
+        last_name="User",
+        membership_id=1257,
+        membership_title="Awaken Hungary Academy",
+        subscription_id="sub_test123456789",
+        price="12490.00",
+        period="1",
+        period_type="months",
+        received_at=received_at
+    )
+
+
+def make_payload(email="test@example.com"):
+    return {
+        "event": "subscription-stopped",
+        "type": "subscription",
+        "data": {
+            "id": "3245",
+            "subscr_id": "sub_test123456789",
+            "gateway": "scvlz8-ji",
+            "price": "12490.00",
+            "period": "1",
+            "period_type": "months",
+            "status": "active",
+            "created_at": "2025-12-01 22:24:17",
+            "total": "12490.00",
+            "membership": {
+                "id": 1257,
+                "title": "Awaken Hungary Academy",
+                "content": "",
+                "price": "12490.00",
+                "period": "1",
+                "period_type": "months"
+            },
+            "member": {
+                "id": 2470,
+                "email": email,
+                "username": "testuser@example.com",
+                "first_name": "Test",
+                "last_name": "User",
+                "display_name": "Test User",
+                "registered_at": "2025-12-01 22:24:17"
+            }
+        }
+    }
+
+
+@pytest.fixture
+def main_module(tmp_path, monkeypatch):
+    monkeypatch.setenv("MAILERLITE_API_KEY", "test")
+    monkeypatch.setenv("PENDING_EVENTS_DIR", str(tmp_path))
+    main = importlib.import_module("main")
+    gate = IngestionGate(max_inflight_bytes=1024 * 1024, store=FilePendingStore(str(tmp_path)))
+    monkeypatch.setattr(main, "ingestion_gate", gate)
+    return main
+
+
+def post_webhook(main, **kwargs):
+    async def run():
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            return await client.post("/webhook/memberpress", **kwargs)
+
+    return asyncio.run(run())
+
+
+def test_webhook_event_keeps_only_handler_fields():
+    event = WebhookEvent.from_webhook(MemberpressWebhook.model_validate(make_payload()))
+
+    assert event.email == "test@example.com"
+    assert event.membership_id == 1257
+    assert event.subscription_id == "sub_test123456789"
+    assert not hasattr(event, "__dict__")
+    assert WebhookEvent.from_dict(event.to_dict()).to_dict() == event.to_dict()
+
+
+def test_oversized_body_is_rejected(main_module):
+    response = post_webhook(main_module, content=b"x" * (main_module.settings.max_body_bytes + 1))
+
+    assert response.status_code == 413
+    assert main_module.ingestion_gate.inflight_bytes == 0
+
+
+def test_webhook_rejected_when_inflight_limit_reached(main_module, monkeypatch):
+    gate = IngestionGate(max_inflight_bytes=100, store=main_module.ingestion_gate.store)
+    monkeypatch.setattr(main_module, "ingestion_gate", gate)
+
+    response = post_webhook(main_module, json=make_payload())
+
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "5"
+    assert gate.inflight_bytes == 0
+
+
+def test_reservation_shrinks_to_compact_record(main_module, monkeypatch):
+    reserved = []
+
+    async def dispatch_event(event):
+        reserved.append((main_module.ingestion_gate.inflight_bytes, event.approximate_size()))
+
+    monkeypatch.setattr(main_module, "dispatch_event", dispatch_event)
+
+    payload = make_payload()
+    payload["data"]["membership"]["content"] = "<p>Membership page</p>" * 200
+    body = json.dumps(payload).encode()
+
+    response = post_webhook(main_module, content=body, headers={"content-type": "application/json"})
+
+    assert response.status_code == 200
+    inflight, record_size = reserved[0]
+    assert inflight == record_size < len(body)
+    assert main_module.ingestion_gate.inflight_bytes == 0
+
+
+def test_invalid_webhook_reports_fastapi_errors_and_releases_reservation(main_module):
+    payload = make_payload()
+    del payload["data"]["member"]["email"]
+
+    response = post_webhook(main_module, json=payload)
+
+    assert response.status_code == 422
+    assert response.json()["detail"] == [{
+        "type": "missing",
+        "loc": ["body", "data", "member", "email"],
+        "msg": "Field required",
+        "input": payload["data"]["member"]
+    }]
+    assert main_module.ingestion_gate.inflight_bytes == 0
+
+
+def test_empty_and_non_json_bodies_match_fastapi(main_module):
+    empty = post_webhook(main_module, content=b"", headers={"content-type": "application/json"})
+    plain = post_webhook(main_module, content=b'{"event": "x"}', headers={"content-type": "text/plain"})
+
+    assert empty.json()["detail"] == [{"type": "missing", "loc": ["body"], "msg": "Field required", "input": None}]
+    assert plain.json()["detail"][0]["type"] == "model_attributes_type"
+    assert plain.json()["detail"][0]["loc"] == ["body"]
+
+
+def test_openapi_documents_webhook_body(main_module):
+    operation = main_module.app.openapi()["paths"]["/webhook/memberpress"]["post"]
+
+    assert operation["requestBody"]["content"]["application/json"]["schema"] == {
+        "$ref": "#/components/schemas/MemberpressWebhook"
+    }
+
+
+def test_drain_saves_unfinished_events_and_replay_completes_them(tmp_path):
+    store = FilePendingStore(str(tmp_path))
+    replayed = []
+
+    async def slow_handler(event):
+        await asyncio.sleep(10)
+
+    async def handler(event):
+        replayed.append(event.to_dict())
+
+    async def run():
+        old = IngestionGate(max_inflight_bytes=1024, store=store)
+        event = make_event()
+        old.submit(event, slow_handler)
+        await old.drain(grace_period=0.05)
+
+        new = IngestionGate(max_inflight_bytes=1024, store=store)
+        assert await new.replay_pending(handler) == 1
+        await new.drain(grace_period=1)
+        return event
+
+    event = asyncio.run(run())
+
+    assert replayed == [event.to_dict()]
+    assert asyncio.run(store.claim()) == []
+
+
+def test_failed_replay_stays_in_store(tmp_path):
+    store = FilePendingStore(str(tmp_path))
+
+    async def failing_handler(event):
+        raise RuntimeError("Mailerlite unavailable")
+
+    async def run():
+        await store.save([make_event()])
+        gate = IngestionGate(max_inflight_bytes=1024, store=store)
+        await gate.replay_pending(failing_handler)
+        await gate.drain(grace_period=1)
+        return await store.claim()
+
+    claimed = asyncio.run(run())
+
+    assert len(claimed) == 1
+
+
+def test_replay_older_than_processed_event_is_skipped(tmp_path):
+    store = FilePendingStore(str(tmp_path))
+    replayed = []
+
+    async def handler(event):
+        replayed.append(event)
+
+    async def run():
+        now = time.time()
+        await store.save([make_event(received_at=now - 10)])
+        await store.record_started("TEST@example.com", now)
+        gate = IngestionGate(max_inflight_bytes=1024, store=store)
+        await gate.replay_pending(handler)
+        await gate.drain(grace_period=1)
+        return await store.claim()
+
+    assert asyncio.run(run()) == []
+    assert replayed == []
+
+
+def test_events_are_claimed_by_only_one_store(tmp_path):
+    first = FilePendingStore(str(tmp_path))
+    second = FilePendingStore(str(tmp_path))
+
+    async def run():
+        await first.save([make_event(email=f"user{i}@example.com") for i in range(5)])
+        return await first.claim(limit=3), await second.claim(), await second.claim()
+
+    claimed_first, claimed_second, claimed_again = asyncio.run(run())
+
+    emails = [event.email for _, event in claimed_first + claimed_second]
+    assert sorted(emails) == [f"user{i}@example.com" for i in range(5)]
+    assert claimed_again == []
+
+
+def test_cancelled_request_keeps_reservation_until_handler_finishes(tmp_path):
+    async def run():
+        gate = IngestionGate(max_inflight_bytes=1024, store=FilePendingStore(str(tmp_path)))
+        finish = asyncio.Event()
+
+        async def handler(event):
+            await finish.wait()
+
+        assert gate.try_acquire(100)
+        task = gate.submit(make_event(), handler, size=100)
+        request = asyncio.create_task(gate.wait(task))
+        await asyncio.sleep(0)
+        request.cancel()
+        await asyncio.gather(request, return_exceptions=True)
+
+        assert not task.done()
+        assert gate.inflight_bytes == 100
+
+        finish.set()
+        await task
+        assert gate.inflight_bytes == 0
+
+    asyncio.run(run())
+
+
+def test_webhook_rejected_once_shutdown_starts(main_module):
+    async def run():
+        main_module.ingestion_gate.begin_shutdown(grace_period=1)
+        transport = httpx.ASGITransport(app=main_module.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            return await client.post("/webhook/memberpress", json={})
+
+    response = asyncio.run(run())
+
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "5"
+
+
+def test_events_older_than_retention_are_set_aside(tmp_path):
+    store = FilePendingStore(str(tmp_path), retention_seconds=60)
+
+    async def run():
+        await store.save([make_event(received_at=time.time() - 120)])
+        return await store.claim()
+
+    assert asyncio.run(run()) == []
+    assert [path.suffix for path in tmp_path.glob("*.json.*")] == [".expired"]
+
+
+def test_expired_file_lease_returns_event_to_store(tmp_path):
+    first = FilePendingStore(str(tmp_path), lease_seconds=0.05)
+    second = FilePendingStore(str(tmp_path), lease_seconds=0.05)
+
+    async def run():
+        await first.save([make_event()])
+        (key, _), = await first.claim()
+        assert await second.claim() == []
+        await asyncio.sleep(0.1)
+        claimed = await second.claim()
+        assert await first.renew(key) is None
+        return claimed
+
+    assert len(asyncio.run(run())) == 1
+
+
+def test_subscriber_lock_serialises_events_per_email(tmp_path):
+    gate = IngestionGate(max_inflight_bytes=1024, store=FilePendingStore(str(tmp_path)))
+    running = []
+    overlaps = []
+
+    async def handler(event):
+        email = event.email.lower()
+        if email in running:
+            overlaps.append(email)
+        running.append(email)
+        await asyncio.sleep(0.01)
+        running.remove(email)
+
+    async def run():
+        events = [make_event(email="a@example.com"), make_event(email="A@example.com"), make_event(email="b@example.com")]
+        tasks = [gate.submit(event, handler) for event in events]
+        await asyncio.sleep(0.005)
+        concurrent = sorted(running)
+        await asyncio.gather(*tasks)
+        return concurrent
+
+    assert asyncio.run(run()) == ["a@example.com", "b@example.com"]
+    assert overlaps == []
+    assert gate._subscriber_locks == {}
+
+
+def test_replays_are_limited_by_slots_and_inflight_bytes(tmp_path):
+    store = FilePendingStore(str(tmp_path))
+    finish = asyncio.Event()
+
+    async def handler(event):
+        await finish.wait()
+
+    async def run():
+        await store.save([make_event(email=f"user{i}@example.com") for i in range(5)])
+        gate = IngestionGate(max_inflight_bytes=1024 * 1024, store=store, max_concurrent_replays=2)
+        assert await gate.replay_pending(handler) == 2
+        assert await gate.replay_pending(handler) == 0
+
+        # Room for one event but not two
+        small = IngestionGate(max_inflight_bytes=make_event().approximate_size() * 3 // 2, store=store)
+        assert await small.replay_pending(handler) == 1
+
+        finish.set()
+        await gate.drain(grace_period=1)
+        await small.drain(grace_period=1)
+        return await store.claim()
+
+    assert len(asyncio.run(run())) == 2
+
+
+def test_shutdown_signal_closes_gate_and_chains_to_server_handler(main_module):
+    received = []
+    saved = {sig: signal.getsignal(sig) for sig in (signal.SIGINT, signal.SIGTERM)}
+
+    async def run():
+        for sig in saved:
+            signal.signal(sig, lambda signum, frame: received.append(signum))
+        assert main_module.install_shutdown_signal_handlers()
+        signal.raise_signal(signal.SIGTERM)
+        await asyncio.sleep(0)
+
+    try:
+        asyncio.run(run())
+    finally:
+        for sig, handler in saved.items():
+            signal.signal(sig, handler)
+
+    assert received == [signal.SIGTERM]
+    assert main_module.ingestion_gate.closed
+
+
+def test_shutdown_signal_handlers_report_missing_server_handler(main_module, caplog):
+    saved = {sig: signal.getsignal(sig) for sig in (signal.SIGINT, signal.SIGTERM)}
+
+    async def run():
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        return main_module.install_shutdown_signal_handlers()
+
+    try:
+        installed = asyncio.run(run())
+    finally:
+        for sig, handler in saved.items():
+            signal.signal(sig, handler)
+
+    assert not installed
+    assert "No server handler for SIGTERM" in caplog.text
+
+
+@pytest.fixture
+def redis_server():
+    fakeredis = pytest.importorskip("fakeredis")
+    return fakeredis.FakeServer()
+
+
+def make_redis_store(server, **kwargs):
+    import fakeredis
+    return RedisPendingStore(fakeredis.FakeAsyncRedis(server=server, decode_responses=True), **kwargs)
+
+
+def test_redis_events_are_claimed_by_only_one_store(redis_server):
+    first = make_redis_store(redis_server)
+    second = make_redis_store(redis_server)
+
+    async def run():
+        await first.save([make_event(email=f"user{i}@example.com") for i in range(5)])
+        claimed_first = await first.claim(limit=3)
+        claimed_second = await second.claim()
+        claimed_again = await second.claim()
+        for key, _ in claimed_first:
+            await first.complete(key)
+        for key, _ in claimed_second:
+            await second.complete(key)
+        return claimed_first, claimed_second, claimed_again, await first.claim()
+
+    claimed_first, claimed_second, claimed_again, remaining = asyncio.run(run())
+
+    emails = [event.email for _, event in claimed_first + claimed_second]
+    assert sorted(emails) == [f"user{i}@example.com" for i in range(5)]
+    assert claimed_again == []
+    assert remaining == []
+
+
+def test_redis_expired_lease_returns_event_to_store(redis_server):
+    first = make_redis_store(redis_server, lease_seconds=0.05)
+    second = make_redis_store(redis_server, lease_seconds=0.05)
+
+    async def run():
+        await first.save([make_event()])
+        (key, _), = await first.claim()
+        assert await second.claim() == []
+        await asyncio.sleep(0.1)
+        claimed = await second.claim()
+        assert await first.renew(key) is None
+        # The first store's late release must not drop the second store's lease
+        await first.release(key)
+        assert await second.renew(key) == key
+        return claimed
+
+    assert len(asyncio.run(run())) == 1
+
+
+def test_redis_event_completed_after_listing_is_not_claimed(redis_server, monkeypatch):
+    first = make_redis_store(redis_server)
+    second = make_redis_store(redis_server)
+
+    async def run():
+        await first.save([make_event()])
+        snapshot = await second.client.hgetall(second.pending_key)
+        (key, _), = await first.claim()
+        await first.complete(key)
+
+        async def stale_hgetall(name):
+            return snapshot
+
+        monkeypatch.setattr(second.client, "hgetall", stale_hgetall)
+        claimed = await second.claim()
+        lease = await second.client.get(second.lease_prefix + key)
+        return claimed, lease
+
+    assert asyncio.run(run()) == ([], None)
+
+
+def test_redis_unreadable_event_is_moved_aside(redis_server):
+    store = make_redis_store(redis_server)
+
+    async def run():
+        await store.client.hset(store.pending_key, "0000000000000-bad", "not json")
+        claimed = await store.claim()
+        return claimed, await store.client.hgetall(store.pending_key), await store.client.hgetall(store.invalid_key)
+
+    claimed, pending, invalid = asyncio.run(run())
+
+    assert claimed == []
+    assert pending == {}
+    assert invalid == {"0000000000000-bad": "not json"}
+
+
+def test_redis_records_latest_started_with_expiry(redis_server):
+    store = make_redis_store(redis_server, retention_seconds=60)
+
+    async def run():
+        await store.record_started("Test@example.com", 200.0)
+        await store.record_started("test@example.com", 100.0)
+        keys = await store.client.keys(store.latest_prefix + "*")
+        return await store.latest_started("test@example.com"), keys, await store.client.pttl(keys[0])
+
+    latest, keys, ttl = asyncio.run(run())
+
+    assert latest == 200.0
+    assert "example.com" not in keys[0]
+    assert 0 < ttl <= 60000